@@ -19,6 +19,52 @@ def _strip_extensions(filename):
     return os.path.splitext(filename)[0]
 
 
+def _available_cpus():
+    """CPUs this job may use (scheduler affinity, or OMP_NUM_THREADS if set)."""
+    # OpenMP allows one count per nesting level ("4,2"); the outer one applies
+    omp = os.environ.get("OMP_NUM_THREADS", "").split(",")[0].strip()
+    if omp.isdigit() and int(omp) > 0:
+        return int(omp)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _configure_sitk():
+    """Match ITK's thread pool to the allotted cores.
+
+    PyRadiomics reads, resamples and filters (LoG, wavelet) through
+    SimpleITK, which otherwise sizes its pool from the whole node.
+    """
+    n = _available_cpus()
+    os.environ.setdefault("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", str(n))
+    import SimpleITK as sitk
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(n)
+
+
+def _inject_torch_radiomics():
+    """Swap PyRadiomics' feature classes for the CUDA ones from torchradiomics.
+
+    Must run before the extractor is built. Returns the extra extractor
+    settings for the GPU classes, or None (CPU extraction) when
+    torchradiomics or a CUDA device is unavailable.
+    """
+    try:
+        import torch
+        from torchradiomics import inject_torch_radiomics
+    except ImportError as e:
+        print(f"  use_gpu: torchradiomics unavailable ({e}), extracting on CPU",
+              file=sys.stderr)
+        return None
+    if not torch.cuda.is_available():
+        print("  use_gpu: no CUDA device, extracting on CPU", file=sys.stderr)
+        return None
+    inject_torch_radiomics()
+    # float64 keeps features within ~1e-9 of the CPU implementation
+    return {"device": "cuda:0", "dtype": torch.float64}
+
+
 def find_pairs_from_roots(image_root, mask_root):
     """Match image-mask pairs by filename."""
     if not os.path.isdir(image_root) or not os.path.isdir(mask_root):
@@ -93,15 +139,18 @@ def _find_mask_for_sample(input_dir, sample_id):
     3. Any NIfTI file containing sample_id in its name
     4. If only one NIfTI file exists, use it (unambiguous single-image case)
     """
-    if not os.path.isdir(input_dir):
+    try:
+        # One directory read; DirEntry.is_file() uses the d_type from
+        # readdir, so no per-file stat (slow on Lustre/NFS)
+        with os.scandir(input_dir) as it:
+            files = [e.name for e in it if e.is_file()]
+    except (FileNotFoundError, NotADirectoryError):
         return None
 
     # Strategy 1: explicit mask/label naming
-    for f in os.listdir(input_dir):
-        fpath = os.path.join(input_dir, f)
-        if os.path.isfile(fpath) and sample_id in f:
-            if "mask" in f.lower() or "label" in f.lower():
-                return fpath
+    for f in files:
+        if sample_id in f and ("mask" in f.lower() or "label" in f.lower()):
+            return os.path.join(input_dir, f)
 
     # Strategy 2: subdirectory matching sample_id (e.g. TotalSegmentator)
     subdir = os.path.join(input_dir, sample_id)
@@ -112,22 +161,78 @@ def _find_mask_for_sample(input_dir, sample_id):
             return os.path.join(subdir, sorted(nifti_files)[0])
 
     # Strategy 3: any NIfTI containing sample_id
-    for f in os.listdir(input_dir):
-        fpath = os.path.join(input_dir, f)
-        if os.path.isfile(fpath) and sample_id in f:
-            if f.endswith((".nii.gz", ".nii", ".nrrd", ".mha")):
-                return fpath
+    images = [f for f in files if f.endswith((".nii.gz", ".nii", ".nrrd", ".mha"))]
+    for f in images:
+        if sample_id in f:
+            return os.path.join(input_dir, f)
 
     # Strategy 4: single unambiguous NIfTI file
-    nifti_all = [f for f in os.listdir(input_dir)
-                 if os.path.isfile(os.path.join(input_dir, f))
-                 and f.endswith((".nii.gz", ".nii", ".nrrd", ".mha"))]
-    if len(nifti_all) == 1:
-        return os.path.join(input_dir, nifti_all[0])
+    if len(images) == 1:
+        return os.path.join(input_dir, images[0])
 
     return None
 
 
+def _build_extractor(settings, **kwargs):
+    from radiomics import featureextractor
+    if settings and settings != "default" and os.path.exists(settings):
+        return featureextractor.RadiomicsFeatureExtractor(settings, **kwargs)
+    return featureextractor.RadiomicsFeatureExtractor(**kwargs)
+
+
+def _read_input(path):
+    """Return a path PyRadiomics can read itself, or, for a DICOM series
+    directory, the volume read via GDCM (per-slice metadata and private
+    tags are skipped)."""
+    if not os.path.isdir(path):
+        return path
+    import SimpleITK as sitk
+    reader = sitk.ImageSeriesReader()
+    files = reader.GetGDCMSeriesFileNames(path)
+    if not files:
+        raise ValueError(f"No DICOM series found in {path}")
+    reader.SetFileNames(files)
+    reader.SetMetaDataDictionaryArrayUpdate(False)
+    reader.SetLoadPrivateTags(False)
+    return reader.Execute()
+
+
+def _extract_pair(extractor, img, mask, sid):
+    """Run the extractor on one pair and return its non-diagnostic features."""
+    print(f"  Extracting: {sid}")
+    result = extractor.execute(_read_input(img), _read_input(mask))
+    features = {}
+    for k, v in result.items():
+        if k.startswith("diagnostics"):
+            continue
+        try:
+            features[k] = float(v)
+        except (TypeError, ValueError):
+            features[k] = str(v)
+    features["sample_id"] = sid
+    return features
+
+
+# Per-process extractor for --n-workers > 1, built once by _init_worker
+_EXTRACTOR = None
+
+
+def _init_worker(settings, threads):
+    global _EXTRACTOR
+    # Split the allotted cores between workers instead of each taking all.
+    # Runs before this spawned process imports numpy/SimpleITK, so the
+    # OpenMP/MKL pools are sized from these
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"):
+        os.environ[var] = str(threads)
+    import SimpleITK as sitk
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+    _EXTRACTOR = _build_extractor(settings)
+
+
+def _extract_in_worker(pair):
+    return _extract_pair(_EXTRACTOR, *pair)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", required=True)
@@ -139,6 +244,11 @@ def main():
                         help="Single mask path (single-image mode)")
     parser.add_argument("--sample-id", default=None,
                         help="Sample identifier (single-image mode)")
+    parser.add_argument("--gpu", action="store_true",
+                        help="Compute features on CUDA via torchradiomics, if available")
+    parser.add_argument("--n-workers", type=int,
+                        default=os.environ.get("DSJOBS_CFG_N_WORKERS") or 1,
+                        help="Image-mask pairs extracted in parallel processes")
     args = parser.parse_args()
 
     # Merge CLI args with env vars (dsJobs sets DSJOBS_CFG_* from config)
@@ -187,31 +297,46 @@ def main():
         print("ERROR: No image-mask pairs found", file=sys.stderr)
         sys.exit(1)
 
-    from radiomics import featureextractor
+    _configure_sitk()
     import pandas as pd
 
-    if args.settings and args.settings != "default" and os.path.exists(args.settings):
-        extractor = featureextractor.RadiomicsFeatureExtractor(args.settings)
-    else:
-        extractor = featureextractor.RadiomicsFeatureExtractor()
+    use_gpu = args.gpu or os.environ.get("DSJOBS_CFG_USE_GPU", "").lower() in ("true", "1", "yes")
+    gpu_settings = _inject_torch_radiomics() if use_gpu else None
+    n_workers = max(1, min(args.n_workers, len(pairs)))
+    if gpu_settings is not None and n_workers > 1:
+        print("  use_gpu: extracting in a single process", file=sys.stderr)
+        n_workers = 1
 
     results = []
-    for img, mask, sid in pairs:
+    if n_workers > 1:
+        # spawn: each worker gets a clean interpreter and its own PyRadiomics
+        # state rather than a fork of this one
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        print(f"  Workers: {n_workers}")
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(args.settings,
+                                           max(1, _available_cpus() // n_workers))) as pool:
+            futures = [(sid, pool.submit(_extract_in_worker, (img, mask, sid)))
+                       for img, mask, sid in pairs]
+            for sid, fut in futures:
+                try:
+                    results.append(fut.result())
+                except Exception as e:
+                    print(f"  FAILED {sid}: {e}", file=sys.stderr)
+    else:
         try:
-            print(f"  Extracting: {sid}")
-            result = extractor.execute(img, mask)
-            features = {}
-            for k, v in result.items():
-                if k.startswith("diagnostics"):
-                    continue
+            extractor = _build_extractor(args.settings, **(gpu_settings or {}))
+            for img, mask, sid in pairs:
                 try:
-                    features[k] = float(v)
-                except (TypeError, ValueError):
-                    features[k] = str(v)
-            features["sample_id"] = sid
-            results.append(features)
-        except Exception as e:
-            print(f"  FAILED {sid}: {e}", file=sys.stderr)
+                    results.append(_extract_pair(extractor, img, mask, sid))
+                except Exception as e:
+                    print(f"  FAILED {sid}: {e}", file=sys.stderr)
+        finally:
+            if gpu_settings is not None:
+                from torchradiomics import restore_radiomics
+                restore_radiomics()
 
     if not results:
         print("ERROR: No features extracted", file=sys.stderr)
@@ -3,8 +3,23 @@
 
 Produces lung/lobe segmentation masks from CT images.
 Models: R231, LTRCLobes, LTRCLobes_R231, R231CovidWeb
+
+With --server the runner stays alive and reads newline-delimited JSON jobs
+from stdin ({"image": ..., "output": ..., "sample_id": ..., "model": ...,
+"force_cpu": ...}; image and output are required), answering each with
+one JSON line on stdout. Model weights are loaded once per
+(model, force_cpu) and reused across jobs.
 """
-import argparse, json, os, sys
+import argparse, functools, json, os, sys
+
+# Runner model name -> (lungmask modelname, fillmodel). LTRCLobes_R231 is
+# LTRCLobes with gaps filled in by R231, which LMInferer takes as fillmodel
+MODELS = {
+    "R231": ("R231", None),
+    "LTRCLobes": ("LTRCLobes", None),
+    "LTRCLobes_R231": ("LTRCLobes", "R231"),
+    "R231CovidWeb": ("R231CovidWeb", None),
+}
 
 
 def find_images(input_dir):
@@ -29,16 +44,549 @@ def find_images(input_dir):
             if not f.startswith(".") and os.path.isfile(os.path.join(input_dir, f))]
 
 
+def _flag(value):
+    """Boolean from a real bool or a "true"/"1"/"yes" string."""
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ("true", "1", "yes")
+
+
+def _cfg_flag(name):
+    """Boolean dsJobs config value (dsJobs sets DSJOBS_CFG_* from config)."""
+    return _flag(os.environ.get(f"DSJOBS_CFG_{name.upper()}", ""))
+
+
+def _available_cpus():
+    """CPUs this job may use (scheduler affinity, or OMP_NUM_THREADS if set)."""
+    # OpenMP allows one count per nesting level ("4,2"); the outer one applies
+    omp = os.environ.get("OMP_NUM_THREADS", "").split(",")[0].strip()
+    if omp.isdigit() and int(omp) > 0:
+        return int(omp)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _configure_threads(num_threads=None):
+    """Give OpenMP/MKL, torch and ITK one thread budget so their pools don't
+    oversubscribe the job's cores. Must run before numpy/torch are imported."""
+    if num_threads:
+        os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    else:
+        os.environ.setdefault("OMP_NUM_THREADS", str(_available_cpus()))
+    os.environ.setdefault("MKL_NUM_THREADS", str(_available_cpus()))
+
+
+def _configure_sitk():
+    """Match ITK's thread pool to the allotted cores (NIfTI gzip read/write)."""
+    n = _available_cpus()
+    os.environ.setdefault("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", str(n))
+    import SimpleITK as sitk
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(n)
+
+
+def _configure_torch(force_cpu):
+    """One-time torch setup. CT slice shapes are fixed (256x256) inside
+    lungmask, so letting cuDNN benchmark conv algorithms pays off."""
+    # Expandable segments let the caching allocator grow in place instead of
+    # cudaMalloc'ing new blocks as activation sizes vary between volumes
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+    import torch
+    # Inference-only process: no autograd for our own model calls either
+    # (warmup, int8 calibration, ONNX/TensorRT export)
+    torch.set_grad_enabled(False)
+    torch.set_num_threads(_available_cpus())
+    try:
+        # lungmask runs one op at a time; extra inter-op threads only compete
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # already set: only allowed once per process
+    if not force_cpu and torch.cuda.is_available():
+        torch.backends.cudnn.benchmark = True
+
+
+def _warmup(inferer):
+    """Run one dummy batch so CUDA context and cuDNN autotuning happen
+    before the first real volume."""
+    import torch
+    if not torch.cuda.is_available():
+        return
+    with torch.inference_mode():
+        inferer.model(torch.zeros((1, 1, 256, 256), device=inferer.device))
+
+
+def _pad_batch(forward, size):
+    """Pad each slice batch up to a multiple of `size()`. lungmask's trailing
+    batch is usually short, which would otherwise trigger a recompile."""
+    import torch
+
+    def padded(x):
+        n = x.shape[0]
+        pad = -n % size()
+        if pad:
+            x = torch.cat([x, x.new_zeros((pad,) + tuple(x.shape[1:]))])
+        return forward(x)[:n]
+    return padded
+
+
+def _channels_last(forward):
+    """Feed the model NHWC input to match channels_last weights."""
+    import torch
+    return lambda x: forward(x.contiguous(memory_format=torch.channels_last))
+
+
+def _autocast(forward, dtype, state=None):
+    """Run the forward pass under CUDA autocast (tensor-core FP16/BF16 convs).
+
+    If a reduced-precision kernel fails, the rest of the run falls back to
+    fp32 instead of failing the volume. `state` is shared with _pinned_h2d
+    so the fallback also switches host staging back to fp32.
+    """
+    import torch
+    state = {"enabled": True} if state is None else state
+
+    def run(x):
+        if state["enabled"]:
+            try:
+                with torch.autocast("cuda", dtype=dtype):
+                    return forward(x)
+            except RuntimeError as e:
+                if "out of memory" in str(e):
+                    raise
+                print(f"  {dtype} autocast failed ({e}), falling back to fp32",
+                      file=sys.stderr)
+                state["enabled"] = False
+        return forward(x)
+    return run
+
+
+def _pinned_h2d(forward, device, batch_size, dtype=None, autocast_state=None):
+    """Stage host batches in one reused page-locked buffer and copy them to
+    the GPU with non_blocking=True, instead of a synchronous pageable copy.
+
+    With reduced precision the buffer holds fp16/bf16, halving the bytes
+    sent over PCIe; autocast casts conv inputs to that dtype anyway. Once
+    `autocast_state` reports autocast disabled, batches are staged in fp32
+    so the fp32 forward sees unrounded input.
+    """
+    import torch
+    buffers = {}
+
+    def staging():
+        enabled = autocast_state is None or autocast_state["enabled"]
+        dt = (dtype if enabled else None) or torch.float32
+        if dt not in buffers:
+            buffers.clear()
+            buffers[dt] = torch.empty((batch_size, 1, 256, 256), dtype=dt, pin_memory=True)
+        return buffers[dt]
+
+    def run(x):
+        n = x.shape[0]
+        buf = staging()
+        if x.device.type != "cpu" or n > buf.shape[0] or x.shape[1:] != buf.shape[1:]:
+            return forward(x.to(device))
+        # Safe to reuse: lungmask syncs on .cpu() of each prediction before
+        # it builds the next batch
+        buf = buf[:n]
+        buf.copy_(x)
+        return forward(buf.to(device, non_blocking=True).to(x.dtype))
+    return run
+
+
+def _int8_forward(model, calibration_batches=4):
+    """Post-training static int8 quantization (FX graph mode) for the CPU path.
+
+    The U-Net has no Linear layers, so quantize_dynamic would leave it
+    untouched. The observed fp32 model serves the first few real batches
+    while it calibrates, then is converted in place.
+    """
+    import copy
+    from lungmask.resunet import UNetUpBlock
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+    state = {"model": None, "seen": 0}
+
+    def run(x):
+        if state["model"] is None:
+            # center_crop unpacks tensor sizes, which FX cannot trace; with
+            # padding=True and 256x256 slices it is the identity anyway
+            crop = UNetUpBlock.__dict__["center_crop"]
+            UNetUpBlock.center_crop = staticmethod(lambda layer, target_size: layer)
+            try:
+                state["model"] = prepare_fx(copy.deepcopy(model),
+                                            get_default_qconfig_mapping("x86"), (x,))
+            finally:
+                UNetUpBlock.center_crop = crop
+        out = state["model"](x)
+        if state["seen"] < calibration_batches:
+            state["seen"] += 1
+            if state["seen"] == calibration_batches:
+                state["model"] = convert_fx(state["model"])
+        return out
+    return run
+
+
+def _cache_dir(backend):
+    """Per-backend cache for compiled engines, next to the model weights."""
+    models_dir = os.environ.get("DSRADIOMICS_MODELS", "/var/lib/dsradiomics/models")
+    return os.path.join(models_dir, "lungmask", ".cache", backend)
+
+
+def _tensorrt_forward(model, modelname, batch_size, fp16):
+    """Compile the U-Net to a TensorRT engine for a fixed (batch, 1, 256, 256)
+    input, caching the serialized engine on disk."""
+    import re
+    import torch
+    import torch_tensorrt
+    shape = (batch_size, 1, 256, 256)
+    device = re.sub(r"[^A-Za-z0-9]+", "-", torch.cuda.get_device_name())
+    name = (f"{modelname}_{'x'.join(map(str, shape))}_{'fp16' if fp16 else 'fp32'}"
+            f"_{device}_trt{torch_tensorrt.__version__}.ts")
+    path = os.path.join(_cache_dir("tensorrt"), name)
+    if os.path.exists(path):
+        engine = torch.jit.load(path)
+    else:
+        print(f"  Building TensorRT engine for {modelname} (one-time)")
+        engine = torch_tensorrt.compile(
+            model, ir="ts", inputs=[torch_tensorrt.Input(shape)],
+            enabled_precisions={torch.half} if fp16 else {torch.float})
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            torch.jit.save(engine, tmp)
+            os.replace(tmp, path)  # concurrent jobs never load a partial engine
+        except OSError as e:
+            print(f"  Warning: cannot cache TensorRT engine: {e}", file=sys.stderr)
+    # The engine has a static shape: pad the trailing batch up to batch_size
+    return _pad_batch(engine, lambda: batch_size)
+
+
+def _onnxruntime_forward(model, modelname):
+    """Export the U-Net to ONNX once (cached on disk) and run it through an
+    ONNX Runtime session, preferring OpenVINO when that provider is present."""
+    from importlib.metadata import version
+    import onnxruntime as ort
+    import torch
+    # Versioned so a weights (lungmask) or exporter (torch) upgrade re-exports
+    name = f"{modelname}_lungmask{version('lungmask')}_torch{torch.__version__}.onnx"
+    path = os.path.join(_cache_dir("onnxruntime"), name)
+    if not os.path.exists(path):
+        print(f"  Exporting {modelname} to ONNX (one-time)")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        except OSError:
+            import tempfile
+            path = os.path.join(tempfile.mkdtemp(), name)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        torch.onnx.export(model, torch.zeros((1, 1, 256, 256)), tmp, opset_version=17,
+                          input_names=["input"], output_names=["output"],
+                          dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}})
+        os.replace(tmp, path)  # concurrent jobs never see a partial export
+    available = ort.get_available_providers()
+    providers = [p for p in ("OpenVINOExecutionProvider", "CPUExecutionProvider")
+                 if p in available]
+    # Same thread budget as torch/OpenMP/ITK, not the node's physical cores
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = _available_cpus()
+    so.inter_op_num_threads = 1
+    session = ort.InferenceSession(path, sess_options=so, providers=providers)
+
+    def run(x):
+        return torch.from_numpy(session.run(None, {"input": x.numpy()})[0])
+    return run
+
+
+def _wrap_models(inferer, wrap):
+    inferer.model = wrap(inferer.model, inferer.modelname)
+    if inferer.fillmodelm is not None:
+        inferer.fillmodelm = wrap(inferer.fillmodelm, inferer.fillmodel)
+
+
+def _accelerate(inferer, compile_model=False, precision="fp32", backend="torch",
+                int8=False):
+    """Apply inference speedups to a freshly built LMInferer.
+
+    lungmask only ever calls ``inferer.model(batch)``, so the model is
+    replaced by a plain callable that layers the enabled options around
+    the original module.
+    """
+    import torch
+    on_cuda = inferer.device.type == "cuda"
+    if compile_model:
+        version = tuple(int(p) for p in torch.__version__.split("+")[0].split(".")[:2])
+        if not on_cuda or version < (2, 1):
+            print("  torch.compile needs CUDA and PyTorch >= 2.1, running eager", file=sys.stderr)
+            compile_model = False
+    autocast_dtype = None
+    if precision != "fp32":
+        if not on_cuda:
+            print(f"  precision={precision} needs CUDA, running fp32", file=sys.stderr)
+        elif precision == "bf16" and torch.cuda.is_bf16_supported():
+            autocast_dtype = torch.bfloat16
+        else:
+            autocast_dtype = torch.float16
+    if backend == "tensorrt" and not on_cuda:
+        print("  backend=tensorrt needs CUDA, using PyTorch", file=sys.stderr)
+        backend = "torch"
+    if backend == "onnxruntime" and on_cuda:
+        print("  backend=onnxruntime is for the CPU path, using PyTorch on GPU",
+              file=sys.stderr)
+        backend = "torch"
+    if int8 and on_cuda:
+        print("  int8 is a CPU-only option, ignoring on GPU", file=sys.stderr)
+        int8 = False
+
+    def torch_forward(model):
+        if int8:
+            return _int8_forward(model)
+        forward = model
+        if on_cuda:
+            # NHWC conv weights let cuDNN skip NCHW<->NHWC conversion kernels
+            model.to(memory_format=torch.channels_last)
+        if compile_model:
+            # reduce-overhead captures CUDA graphs, removing per-kernel launch cost
+            forward = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+        if on_cuda:
+            forward = _channels_last(forward)
+        if compile_model:
+            # read at call time: infer_one() may shrink batch_size on OOM
+            forward = _pad_batch(forward, lambda: inferer.batch_size)
+        return forward
+
+    def build(model, name):
+        forward = None
+        if backend == "tensorrt":
+            try:
+                forward = _tensorrt_forward(model, name, inferer.batch_size,
+                                            autocast_dtype is not None)
+            except Exception as e:
+                print(f"  TensorRT unavailable ({e}), using PyTorch", file=sys.stderr)
+        elif backend == "onnxruntime":
+            try:
+                forward = _onnxruntime_forward(model, name)
+            except Exception as e:
+                print(f"  ONNX Runtime unavailable ({e}), using PyTorch", file=sys.stderr)
+        # A TensorRT fp16 engine has no fp32 fallback, so its state stays enabled
+        autocast_state = {"enabled": True}
+        use_autocast = forward is None and autocast_dtype is not None
+        if forward is None:
+            forward = torch_forward(model)
+        if on_cuda:
+            forward = _pinned_h2d(forward, inferer.device, inferer.batch_size,
+                                  autocast_dtype, autocast_state)
+        if use_autocast:
+            # Outermost, so a fallback retries the batch from the caller's
+            # unrounded input, which _pinned_h2d then stages in fp32
+            forward = _autocast(forward, autocast_dtype, autocast_state)
+        return forward
+
+    _wrap_models(inferer, build)
+    if on_cuda:
+        # lungmask now builds each batch on the host; _pinned_h2d moves it
+        inferer.device = torch.device("cpu")
+
+
+# Bounded so a long-lived --server process doesn't keep every model a client
+# ever asked for resident on the GPU
+@functools.lru_cache(maxsize=4)
+def _load_inferer(model, force_cpu, batch_size, warm, opts):
+    _configure_torch(force_cpu)
+    from lungmask import LMInferer
+    modelname, fillmodel = MODELS[model]
+    inferer = LMInferer(modelname=modelname, fillmodel=fillmodel, force_cpu=force_cpu,
+                        batch_size=batch_size)
+    _accelerate(inferer, **dict(opts))
+    if warm and not force_cpu:
+        _warmup(inferer)
+    return inferer
+
+
+def _get_inferer(model, force_cpu=False, warm=False, batch_size=20, **opts):
+    """Return a cached LMInferer for (model, force_cpu, batch_size, opts),
+    loading it on first use."""
+    return _load_inferer(model, force_cpu, batch_size, warm, tuple(sorted(opts.items())))
+
+
+def read_image(img_path):
+    """Read a volume file, or a DICOM series directory via GDCM with all
+    allotted threads (per-slice metadata and private tags are skipped)."""
+    import SimpleITK as sitk
+    if not os.path.isdir(img_path):
+        return sitk.ReadImage(img_path)
+    reader = sitk.ImageSeriesReader()
+    files = reader.GetGDCMSeriesFileNames(img_path)
+    if not files:
+        raise ValueError(f"No DICOM series found in {img_path}")
+    reader.SetFileNames(files)
+    reader.SetNumberOfThreads(_available_cpus())
+    reader.SetMetaDataDictionaryArrayUpdate(False)
+    reader.SetLoadPrivateTags(False)
+    return reader.Execute()
+
+
+def infer_one(inferer, image):
+    """Run lungmask on a read volume and return the mask as an sitk.Image
+    with the input's geometry."""
+    import SimpleITK as sitk
+    model_input = image
+    if image.GetPixelID() in (sitk.sitkUInt16, sitk.sitkInt32, sitk.sitkUInt32,
+                              sitk.sitkInt64, sitk.sitkUInt64):
+        # lungmask clips to [-1024, 600] HU first thing, so clamping to int16
+        # here is lossless and shrinks every copy it makes of the volume
+        model_input = sitk.Clamp(image, outputPixelType=sitk.sitkInt16,
+                                 lowerBound=-1024, upperBound=600)
+    while True:
+        try:
+            mask = inferer.apply(model_input)
+            break
+        except RuntimeError as e:
+            # torch.cuda.OutOfMemoryError subclasses RuntimeError
+            if "out of memory" not in str(e) or inferer.batch_size <= 1:
+                raise
+            import torch
+            torch.cuda.empty_cache()
+            inferer.batch_size = max(1, inferer.batch_size // 2)
+            print(f"  CUDA out of memory, retrying with batch_size={inferer.batch_size}",
+                  file=sys.stderr)
+    mask_sitk = sitk.GetImageFromArray(mask)
+    mask_sitk.CopyInformation(image)
+    return mask_sitk
+
+
+def write_mask(mask_sitk, output_dir, sample_id, compress=True, compression_level=1):
+    """Write <sample_id>_lungmask.nii[.gz] and return its path."""
+    import SimpleITK as sitk
+    out_path = os.path.join(output_dir, f"{sample_id}_lungmask.nii{'.gz' if compress else ''}")
+    # Single-threaded zlib dominates the write of a large mask; a label map
+    # compresses nearly as well at level 1 as at the default 6
+    writer = sitk.ImageFileWriter()
+    writer.SetFileName(out_path)
+    writer.SetUseCompression(compress)
+    writer.SetCompressionLevel(compression_level)
+    writer.Execute(mask_sitk)
+    return out_path
+
+
+def segment_one(inferer, img_path, sample_id, output_dir, **write_opts):
+    """Segment one image and write its mask. Returns the mask path."""
+    return write_mask(infer_one(inferer, read_image(img_path)), output_dir, sample_id,
+                      **write_opts)
+
+
+def serve(default_model, default_force_cpu=False, write_opts=None, **opts):
+    """Process newline-delimited JSON jobs from stdin until EOF."""
+    # stdout carries the protocol; route prints and lungmask's logger to stderr
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    _configure_sitk()
+    print(f"LungMask server ready (default model: {default_model})")
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+            image = job["image"]
+            if not isinstance(image, str):
+                raise TypeError("'image' must be a path string")
+            sid = job.get("sample_id") or os.path.splitext(os.path.basename(image))[0]
+        except Exception as e:
+            out.write(json.dumps({"status": "failed", "error": f"Bad job: {e}"}) + "\n")
+            out.flush()
+            continue
+        model = job.get("model") or default_model
+        output_dir = job.get("output")
+        # "false" from a JSON client must not mean True
+        force_cpu = _flag(job.get("force_cpu", default_force_cpu))
+        # No default output: masks written next to the images would be picked
+        # up as CT volumes by the next collection run (and image roots may be
+        # read-only)
+        if not output_dir or not isinstance(output_dir, str):
+            error = "Bad job: 'output' is required"
+        elif not isinstance(model, str) or model not in MODELS:
+            error = f"Bad job: unknown model {model!r}"
+        elif not os.path.exists(image):
+            error = "Image file not found"
+        else:
+            error = None
+        if error:
+            out.write(json.dumps({"sample_id": sid, "status": "failed", "error": error}) + "\n")
+            out.flush()
+            continue
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            inferer = _get_inferer(model, force_cpu, warm=True, **opts)
+            print(f"  Segmenting: {sid}")
+            mask_path = segment_one(inferer, image, sid, output_dir, **(write_opts or {}))
+            result = {"sample_id": sid, "status": "done", "primary_mask": mask_path}
+        except Exception as e:
+            print(f"  FAILED {sid}: {e}", file=sys.stderr)
+            result = {"sample_id": sid, "status": "failed", "error": str(e)}
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input", required=True)
-    parser.add_argument("--output", required=True)
-    parser.add_argument("--model", default="R231")
+    parser.add_argument("--input", default=None)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--model", choices=sorted(MODELS), default="R231")
     parser.add_argument("--image", default=None,
                         help="Single image path (single-image mode)")
     parser.add_argument("--sample-id", default=None,
                         help="Sample identifier (single-image mode)")
+    parser.add_argument("--cpu", action="store_true",
+                        help="Force CPU inference even if a GPU is available")
+    parser.add_argument("--compile", action="store_true",
+                        help="torch.compile the U-Net (GPU, PyTorch >= 2.1)")
+    parser.add_argument("--precision", choices=("fp32", "fp16", "bf16"),
+                        default=os.environ.get("DSJOBS_CFG_PRECISION", "fp32").lower(),
+                        help="Inference precision on GPU (autocast)")
+    parser.add_argument("--backend", choices=("torch", "tensorrt", "onnxruntime"),
+                        default=os.environ.get("DSJOBS_CFG_BACKEND", "torch").lower(),
+                        help="Inference backend for the U-Net")
+    parser.add_argument("--int8", action="store_true",
+                        help="Static int8 quantization of the U-Net (CPU only)")
+    parser.add_argument("--batch-size", type=int,
+                        default=os.environ.get("DSJOBS_CFG_BATCH_SIZE") or 20,
+                        help="CT slices per forward pass (halved automatically on CUDA OOM)")
+    parser.add_argument("--num-threads", type=int,
+                        default=os.environ.get("DSJOBS_CFG_NUM_THREADS") or 0,
+                        help="CPU threads for torch/OpenMP/ITK (default: allotted cores)")
+    parser.add_argument("--no-compress", action="store_true",
+                        help="Write masks as raw .nii instead of .nii.gz")
+    parser.add_argument("--compression-level", type=int,
+                        default=os.environ.get("DSJOBS_CFG_COMPRESSION_LEVEL") or 1,
+                        help="gzip level for .nii.gz masks (1 = fastest)")
+    parser.add_argument("--server", action="store_true",
+                        help="Serve newline-delimited JSON jobs from stdin")
     args = parser.parse_args()
+    # argparse runs `type` on the DSJOBS_CFG_* string defaults (a bad int is
+    # reported via parser.error) but never checks them against `choices`
+    if args.precision not in ("fp32", "fp16", "bf16"):
+        parser.error(f"argument --precision: invalid choice: {args.precision!r} "
+                     "(choose from 'fp32', 'fp16', 'bf16')")
+    if args.backend not in ("torch", "tensorrt", "onnxruntime"):
+        parser.error(f"argument --backend: invalid choice: {args.backend!r} "
+                     "(choose from 'torch', 'tensorrt', 'onnxruntime')")
+
+    _configure_threads(args.num_threads if args.num_threads > 0 else None)
+    force_cpu = args.cpu or _cfg_flag("force_cpu")
+    opts = {"compile_model": args.compile or _cfg_flag("compile"),
+            "precision": args.precision, "backend": args.backend,
+            "int8": args.int8 or _cfg_flag("int8"), "batch_size": max(1, args.batch_size)}
+
+    compress = not (args.no_compress
+                    or os.environ.get("DSJOBS_CFG_COMPRESS", "").lower() in ("false", "0", "no"))
+    write_opts = {"compress": compress, "compression_level": args.compression_level}
+
+    if args.server:
+        serve(args.model, force_cpu, write_opts, **opts)
+        return
+    if not args.input or not args.output:
+        parser.error("--input and --output are required unless --server is given")
 
     print(f"LungMask inference")
     print(f"  Model: {args.model}")
@@ -57,26 +605,53 @@ def main():
     print(f"  Found {len(images)} images")
     os.makedirs(args.output, exist_ok=True)
 
-    import SimpleITK as sitk
-    from lungmask import LMInferer
-
-    inferer = LMInferer(modelname=args.model)
-    results = []
+    # Reject missing inputs before SimpleITK/torch are imported and the
+    # model is loaded; a job with nothing to segment exits in milliseconds
+    results, pending = [], []
     for img_path, sample_id in images:
+        if os.path.exists(img_path):
+            pending.append((img_path, sample_id))
+        else:
+            print(f"  FAILED {sample_id}: image file not found", file=sys.stderr)
+            results.append({"sample_id": sample_id, "status": "failed",
+                            "error": "Image file not found"})
+
+    if pending:
+        _configure_sitk()
+        inferer = _get_inferer(args.model, force_cpu, **opts)
+
+    def finish(sample_id, fut):
         try:
-            print(f"  Segmenting: {sample_id}")
-            image = sitk.ReadImage(img_path)
-            mask = inferer.apply(image)
-            # Save mask as NIfTI
-            mask_sitk = sitk.GetImageFromArray(mask)
-            mask_sitk.CopyInformation(image)
-            out_path = os.path.join(args.output, f"{sample_id}_lungmask.nii.gz")
-            sitk.WriteImage(mask_sitk, out_path)
-            results.append({"sample_id": sample_id, "status": "done"})
+            results.append({"sample_id": sample_id, "status": "done", "mask": fut.result()})
         except Exception as e:
             print(f"  FAILED {sample_id}: {e}", file=sys.stderr)
             results.append({"sample_id": sample_id, "status": "failed", "error": str(e)})
 
+    # Three-stage pipeline: read image i+1 and gzip-write mask i-1 on
+    # background threads while image i is segmented; the ITK reader/writer
+    # and the forward pass all run in native code
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+        nxt = reader.submit(read_image, pending[0][0]) if pending else None
+        last_write = None
+        for i, (img_path, sample_id) in enumerate(pending):
+            fut = nxt
+            nxt = reader.submit(read_image, pending[i + 1][0]) if i + 1 < len(pending) else None
+            try:
+                print(f"  Segmenting: {sample_id}")
+                mask = infer_one(inferer, fut.result())
+            except Exception as e:
+                print(f"  FAILED {sample_id}: {e}", file=sys.stderr)
+                results.append({"sample_id": sample_id, "status": "failed", "error": str(e)})
+                continue
+            # At most one write in flight, so finished masks can't pile up in RAM
+            if last_write is not None:
+                finish(*last_write)
+            last_write = (sample_id, writer.submit(write_mask, mask, args.output, sample_id,
+                                                   **write_opts))
+        if last_write is not None:
+            finish(*last_write)
+
     summary = {"n_total": len(images), "n_done": sum(1 for r in results if r["status"] == "done"),
                "n_failed": sum(1 for r in results if r["status"] == "failed"), "model": args.model}
     with open(os.path.join(args.output, "segmentation_summary.json"), "w") as f:
@@ -87,7 +662,7 @@ def main():
     for r in results:
         sid = r["sample_id"]
         if r["status"] == "done":
-            mask_path = os.path.join(args.output, f"{sid}_lungmask.nii.gz")
+            mask_path = r["mask"]
             seg_manifest["samples"][sid] = {
                 "sample_id": sid,
                 "primary_mask": mask_path,